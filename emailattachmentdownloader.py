@@ -6,14 +6,30 @@ emailattachmentdownloader --help
 """
 
 
-import collections
+import binascii
+import concurrent.futures
 import datetime
 import email
+import email.feedparser
+import email.message
+import email.parser
 import imaplib
+import io
+import itertools
 import re
 import sys
+import zlib
 
 import click
+from titan import utilities
+
+
+_ARCHIVE_BATCH_SIZE = 500
+_FETCH_ONE_BATCH_SIZE = 20
+_REGEX_METACHARACTERS = frozenset(".^$*+?{}[]()|\\")
+_UID_PATTERN = re.compile(rb"UID (\d+)")
+_UPLOAD_WORKERS = 8
+_MAX_PENDING_UPLOADS = 2 * _UPLOAD_WORKERS
 
 
 class EmailDownloaderError(Exception):
@@ -44,9 +60,87 @@ class _DateType(click.ParamType):
             self.fail("Incorrect date format, should be YYYY-MM-DD")
 
 
+class _DeflateIMAP4_SSL(imaplib.IMAP4_SSL):
+    """An IMAP4 over SSL client that can negotiate the COMPRESS=DEFLATE extension (RFC 4978).
+
+    Once compress() succeeds, everything sent and received over the connection is raw DEFLATE compressed, which imaplib
+    doesn't support natively, so send(), read() and readline() are overridden to (de)compress the data.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = bytearray()
+        super().__init__(*args, **kwargs)
+
+    def _inflate(self):
+        """Decompress the next chunk of received data into the inflated buffer, returning False at EOF."""
+        data = self.file.read1(16384)
+        if not data:
+            return False
+        self._inflated += self._decompressor.decompress(data)
+        return True
+
+    def compress(self):
+        """Ask the server to compress the connection, returning whether it is now compressed.
+
+        The capabilities are refreshed first, as servers often only advertise COMPRESS=DEFLATE once logged in.
+
+        """
+        response, data = self.capability()
+        if response == "OK" and data != [None]:
+            self.capabilities = tuple(data[-1].decode().upper().split())
+        if "COMPRESS=DEFLATE" not in self.capabilities:
+            return False
+        imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))  # RFC 4978, unknown to imaplib
+        response, _ = self._simple_command("COMPRESS", "DEFLATE")
+        if response != "OK":
+            return False
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return True
+
+    def read(self, size):
+        """Read 'size' bytes from remote."""
+        if self._decompressor is None:
+            return super().read(size)
+        while len(self._inflated) < size and self._inflate():
+            pass
+        with memoryview(self._inflated) as inflated:
+            data = bytes(inflated[:size])
+        del self._inflated[:size]
+        return data
+
+    def readline(self):
+        """Read line from remote."""
+        if self._decompressor is None:
+            return super().readline()
+        while True:
+            end = self._inflated.find(b"\n") + 1
+            if end:
+                break
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            if not self._inflate():
+                end = len(self._inflated)
+                break
+        if end > imaplib._MAXLINE:
+            raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+        line = bytes(self._inflated[:end])
+        del self._inflated[:end]
+        return line
+
+    def send(self, data):
+        """Send data to remote."""
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+
 class TitanFlowManager(object):
     def __init__(self, imap_ssl_host, username, password, fetch_one, match_date_received, email_subject, email_sender,
-                 filename_pattern, archive_folder, load_date):
+                 filename_pattern, archive_folder, load_date, fetch_batch_size, search_window):
         """Initialise an object that controls the flow of the application.
 
         Positional Arguments:
@@ -63,8 +157,14 @@ class TitanFlowManager(object):
         8. filename_pattern (string): The regular expression pattern to use to match attachment filenames
         9. archive_folder (string): If provided, all 'matched' emails will be moved to this folder. If the archive
         folder is a sub folder, use parent/child syntax. Note that the existence of this folder is checked immediately
-        to avoid a situation where attachments are succesfully downloaded & uploaded but the emails unmoved
-        10. load_date (datetime.date): the load_date which is inused unless match_date_received is True
+        to avoid a situation where attachments are succesfully downloaded & uploaded but the emails unmoved. The name
+        must not contain the wildcards % or *
+        10. load_date (datetime.date): if match_date_received is True, the day before the emails were received,
+        otherwise the date the search_window counts back from
+        11. fetch_batch_size (int): The maximum number of emails whose headers are requested from the IMAP server in
+        a single FETCH command. Full emails are always fetched one at a time
+        12. search_window (int): If match_date_received is False, the search will be restricted to emails that were
+        received at most this number of days before the load_date. If 0, all emails are searched
 
         """
         self.imap_ssl_host = imap_ssl_host
@@ -72,27 +172,243 @@ class TitanFlowManager(object):
         self.password = password
         self.fetch_one = fetch_one
         self.match_date_received = match_date_received
-        self.email_subject = re.compile(email_subject)
-        self.email_sender = re.compile(email_sender)
-        self.filename_pattern = re.compile(filename_pattern)
+        self.email_subject = email_subject
+        self.email_sender = email_sender
+        self.filename_pattern = filename_pattern
+        self._subject_ok = self._compile_matcher(email_subject)
+        self._sender_ok = self._compile_matcher(email_sender)
+        self._name_ok = self._compile_matcher(filename_pattern)
         self.archive_folder = archive_folder
         self.load_date = load_date
+        self.fetch_batch_size = fetch_batch_size
+        self.search_window = search_window
+        self._acquire_program = None
+        self._blob_prefix = None
+
+    @property
+    def acquire_program(self):
+        """The utilities.AcquireProgram instance, created on first use."""
+        if self._acquire_program is None:
+            self._acquire_program = utilities.AcquireProgram()
+        return self._acquire_program
+
+    @property
+    def logger(self):
+        """The acquire_program's logger."""
+        return self.acquire_program.logger
+
+    @staticmethod
+    def _compile_matcher(pattern):
+        """Return a function that takes a string and returns whether the regular expression pattern matches it.
+
+        A regular expression is only compiled when it is needed: a pattern that matches anything (the default of r".*")
+        becomes a function that always returns True, and a pattern without any metacharacters becomes a plain
+        str.startswith check.
+
+        Positional Arguments:
+        1. pattern (string): the regular expression pattern
+
+        """
+        if pattern in (".*", "", None):
+            return lambda value: True
+        if _REGEX_METACHARACTERS.isdisjoint(pattern):
+            return lambda value: value is not None and value.startswith(pattern)
+        return re.compile(pattern).match
+
+    @staticmethod
+    def _iter_attachments(mail, filename_match):
+        """Yield the parts of the mail that are attachments with a filename (Content-Description) that matches.
+
+        This replaces EmailMessage.iter_attachments() followed by a filename check, and follows the same rule of what
+        counts as an attachment: any part other than the first text/plain and text/html parts (that aren't marked as
+        attachments) of a multipart, which are the email body. Unlike iter_attachments, nested multiparts are walked
+        too, except for multipart/alternative subtrees, which only hold alternative versions of the email body. Parts
+        without a Content-Description are skipped as it provides the filename that the blob is named after.
+
+        Positional Arguments:
+        1. mail (email.message.EmailMessage): the email to search for attachments
+        2. filename_match (function): the function used to check each attachment's filename
+
+        """
+        parts = [mail] if mail.get_content_maintype() == "multipart" else []  # otherwise the mail is all body
+        while parts:
+            part = parts.pop()
+            if part.get_content_maintype() == "multipart":
+                if part.get_content_subtype() == "alternative":
+                    continue
+                body_subtypes = set()
+                subparts = []
+                for subpart in part.get_payload():
+                    subtype = subpart.get_content_subtype()
+                    if (subpart.get_content_type() in ("text/plain", "text/html") and not subpart.is_attachment()
+                            and subtype not in body_subtypes):
+                        body_subtypes.add(subtype)
+                    else:
+                        subparts.append(subpart)
+                parts.extend(reversed(subparts))
+            elif part["Content-Description"] is not None and filename_match(part["Content-Description"]):
+                yield part
+
+    @staticmethod
+    def _iter_batches(iterable, batch_size):
+        """Yield lists of up to batch_size consecutive items from the iterable.
+
+        Positional Arguments:
+        1. iterable (iterable): the items to batch
+        2. batch_size (int): the maximum number of items in each list
+
+        """
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    @staticmethod
+    def _iter_decoded_payload(attachment, chunk_size=65536):
+        """Yield the base64 encoded attachment's decoded byte payload in chunks.
+
+        Unlike get_payload(decode=True), this never holds an encoded bytes copy of the whole payload in memory. Each
+        chunk decodes up to chunk_size characters of the payload, carrying any characters left over from the last
+        4 character base64 quantum over to the next chunk.
+
+        Positional Arguments:
+        1. attachment (email.message.EmailMessage): the attachment whose payload is base64 encoded
+
+        Keyword Arguments:
+        1. chunk_size (int): the number of encoded characters to decode at a time
+
+        """
+        encoded = attachment.get_payload()
+        remainder = ""
+        for start in range(0, len(encoded), chunk_size):
+            chunk = remainder + "".join(encoded[start:start + chunk_size].split())
+            end = len(chunk) - len(chunk) % 4
+            remainder = chunk[end:]
+            if end:
+                yield binascii.a2b_base64(chunk[:end])
+        if remainder:
+            yield binascii.a2b_base64(remainder + "=" * (-len(remainder) % 4))
+
+    @staticmethod
+    def _iter_fetch_response(data):
+        """Yield tuples of (uid, payload) for each message contained in the data returned by an imap.uid FETCH call.
+
+        The response data is a list in which each message is represented by an (envelope, payload) tuple followed by a
+        closing b")". The UID is normally reported in the envelope, but some servers send it after the payload instead.
+
+        Positional Arguments:
+        1. data (list): the second argument returned by imap.uid("fetch", ...) calls
+
+        """
+        for index, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            envelope, payload = item
+            match = _UID_PATTERN.search(envelope)
+            if match is None and index + 1 < len(data) and isinstance(data[index + 1], bytes):
+                match = _UID_PATTERN.search(data[index + 1])
+            if match is None:
+                raise EmailDownloaderError("The IMAP server did not return a UID for %s." % envelope.decode())
+            yield match.group(1), payload
+
+    @staticmethod
+    def _literal_prefix(pattern):
+        """Return the whole words of literal text that any string matched (from the start) by the regex must begin with.
+
+        The text is cut back to its last non-word character, so that it never ends part way through a word. An empty
+        string is returned if no such text can be determined, e.g. because the pattern begins with a metacharacter,
+        contains an alternation anywhere or doesn't begin with a complete word.
+
+        Positional Arguments:
+        1. pattern (string): the regular expression pattern
+
+        """
+        if "|" in pattern:
+            return ""
+        prefix = []
+        index = 1 if pattern.startswith("^") else 0
+        while index < len(pattern):
+            character = pattern[index]
+            if character == "\\":
+                character = pattern[index + 1:index + 2]
+                if not character or character.isalnum():
+                    break
+                index += 1
+            elif character in _REGEX_METACHARACTERS:
+                if character in "*?{" and prefix:
+                    # the quantifier makes the preceding character optional, and the word it is in is cut below
+                    prefix.pop()
+                break
+            prefix.append(character)
+            index += 1
+        # the next character might continue the last word, e.g. r"Invoice.*" matches "Invoices"
+        while prefix and (prefix[-1].isalnum() or prefix[-1] == "_"):
+            prefix.pop()
+        prefix = "".join(prefix).strip()
+        return prefix if any(character.isalnum() for character in prefix) else ""
+
+    @staticmethod
+    def _iter_uids_descending(search_data):
+        """Yield the uids in the data returned by an imap.uid SEARCH call, from last to first.
 
-        from titan import utilities
-        self.acquire_program = utilities.AcquireProgram()
-        self.logger = self.acquire_program.logger
+        The uids are sliced out from the end of the space separated data one at a time, rather than split into a list
+        and reversed, as the search can return a very large number of uids.
+
+        Positional Arguments:
+        1. search_data (bytes): the space separated uids, i.e. the first item of the second argument returned by
+        imap.uid("search", ...) calls
+
+        """
+        end = len(search_data)
+        while end > 0:
+            start = search_data.rfind(b" ", 0, end) + 1
+            if start < end:
+                yield search_data[start:end]
+            end = start - 1
 
     @staticmethod
-    def _item_to_datetime(item):
-        """Convert the string date to a datetime object for sorting purposes.
+    def _parse_email(raw_mail, chunk_size=8192):
+        """Parse the raw email bytes into an email.message.EmailMessage.
 
-        This is a helper func, designed to be passed to sorted()'s key param.
+        email.message_from_bytes decodes the whole email to a str, and copies that again into a StringIO, before
+        parsing it. Feeding a BytesFeedParser chunk_size bytes at a time instead avoids those whole-email copies,
+        though the raw bytes themselves are still held in memory while they're parsed.
 
         Positional Arguments:
-        1. item (tuple): tuple of (uid, mail)
+        1. raw_mail (bytes): the full RFC822 email
+
+        Keyword Arguments:
+        1. chunk_size (int): the number of bytes to feed the parser at a time
 
         """
-        return datetime.datetime.strptime(item[1]["Date"], "%a, %d %b %Y %H:%M:%S %z")
+        parser = email.feedparser.BytesFeedParser(_factory=email.message.EmailMessage)
+        for start in range(0, len(raw_mail), chunk_size):
+            parser.feed(raw_mail[start:start + chunk_size])
+        return parser.close()
+
+    @staticmethod
+    def _quote(value):
+        """Return the value as an IMAP quoted string.
+
+        Positional Arguments:
+        1. value (string): the value to quote
+
+        """
+        return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+    @staticmethod
+    def _quote_mailbox(name):
+        """Return the mailbox name as an IMAP quoted string, unless it is already quoted.
+
+        Positional Arguments:
+        1. name (string): the mailbox name
+
+        """
+        if len(name) >= 2 and name.startswith('"') and name.endswith('"'):
+            return name
+        return TitanFlowManager._quote(name)
 
     @staticmethod
     def raise_if_not_ok(response, message):
@@ -109,97 +425,218 @@ class TitanFlowManager(object):
     def archive_uids(self, imap, uids):
         """Move the emails identified by the uids out of the inbox and into the archive folder.
 
+        Rather than one COPY and STORE per email, each command is sent once for every batch of up to 500 uids, as some
+        servers limit the size of the UID set they accept.
+
         Positional Arguments:
         1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
         2. uids (iterable): the iterable containing the email unique IDs to archive
 
         """
-        imap.select()  # get out of readonly mode for the moving
-        for uid in uids:
-            self.raise_if_not_ok(*imap.uid("COPY", uid, self.archive_folder))
-            self.raise_if_not_ok(*imap.uid("STORE", uid, "+FLAGS", "(\Deleted)"))
+        raise_if_not_ok = self.raise_if_not_ok
+        archive_mailbox = self._quote_mailbox(self.archive_folder)
+        for uid_batch in self._iter_batches(uids, _ARCHIVE_BATCH_SIZE):
+            uid_set = b",".join(uid_batch)
+            raise_if_not_ok(*imap.uid("COPY", uid_set, archive_mailbox))
+            raise_if_not_ok(*imap.uid("STORE", uid_set, "+FLAGS", r"(\Deleted)"))
         imap.expunge()
 
+    def fetch(self, imap, uids, message_parts):
+        """Yield tuples of (uid, payload) for the uids, requesting them from the IMAP server in batches.
+
+        Each batch is requested with a single UID FETCH command over a comma separated UID set, so that the number of
+        round trips to the server is divided by the fetch_batch_size. Note that the server may return the messages of a
+        batch in any order.
+
+        Positional Arguments:
+        1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
+        2. uids (iterable): the uids to fetch
+        3. message_parts (string): the FETCH message data item names, e.g. "(RFC822)"
+
+        """
+        for uid_batch in self._iter_batches(uids, self.fetch_batch_size):
+            response, data = imap.uid("fetch", b",".join(uid_batch), message_parts)
+            self.raise_if_not_ok(response, data)
+            yield from self._iter_fetch_response(data)
+
     def get_attachments(self, imap):
         """Yield tuples of (uid, attachment) for each email+attachment that matches the given criteria.
 
         If the archive folder is provided, check this exists first, if not raise an EmailDownloaderError. Then, iterate
-        through emails (most recent to old) - either all or restricted to the day after the load_date if
-        match_date_received was True. For each email, check that the subject and sender matches the given patterns and
-        if so, iterate through the attachments, only yielding values if the attachment filename also matches the
-        provided pattern. If fetch_one is True, yield the first matching email's matching attachments, otherwise yield
-        all matches. Finally, if 0 matches are found, raise an EmailDownloaderError.
+        through emails (most recent to old, by uid) - either those received within the search_window or restricted to
+        the day after the load_date if match_date_received was True, narrowed down on the server by the literal prefixes
+        of the subject and sender patterns where they have one. For each email, check that the subject and sender
+        matches the given patterns and if so, iterate through the attachments, only yielding values if the attachment
+        filename also matches the provided pattern. If fetch_one is True, yield the first matching email's matching
+        attachments, otherwise yield all matches. Finally, if 0 matches are found, raise an EmailDownloaderError.
 
         Positional Arguments:
 
-        1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
+        1. imap (imaplib.IMAP4_SSL): the logged in imap object, with the inbox selected, to use to interact with the
+        email server
 
         """
         if self.archive_folder is not None:
-            self.raise_if_not_ok(*imap.select(self.archive_folder, readonly=True))
-        imap.select(readonly=True)
-        if self.match_date_received:
-            on_value = (self.load_date + datetime.timedelta(days=1)).strftime("%d-%b-%Y")
-            uids = imap.uid("search", None, "ON %s" % on_value)[1][0].split()
-        else:
-            uids = imap.uid("search", None, "ALL")[1][0].split()
-        sorted_emails = self.sort_uids(imap, uids)
+            if "%" in self.archive_folder or "*" in self.archive_folder:
+                raise EmailDownloaderError("The archive folder %s must not contain the wildcards %% or *."
+                                           % self.archive_folder)
+            # LIST rather than SELECT, so that the inbox stays selected
+            response, data = imap.list('""', self._quote_mailbox(self.archive_folder))
+            self.raise_if_not_ok(response, data)
+            selectable = False
+            for mailbox in data:
+                if isinstance(mailbox, tuple):  # the name was sent as a literal
+                    mailbox = mailbox[0]
+                if mailbox is not None:
+                    flags = mailbox[:mailbox.find(b")") + 1].lower()
+                    selectable = b"\\noselect" not in flags and b"\\nonexistent" not in flags
+            if not selectable:
+                raise EmailDownloaderError("The archive folder %s does not exist or cannot hold emails."
+                                           % self.archive_folder)
+        response, data = imap.uid("search", None, *self.get_search_criteria())
+        self.raise_if_not_ok(response, data)
+        matched_uids = self.match_uids(imap, self._iter_uids_descending(data[0]))
+        iter_attachments = self._iter_attachments
+        filename_match = self._name_ok
         attachments_found = False
-        for uid, mail in sorted_emails.items():
-            if self.email_subject.match(mail["Subject"]) and self.email_sender.match(mail["From"]):
-                for attachment in mail.iter_attachments():
-                    if self.filename_pattern.match(attachment["Content-Description"]):
-                        attachments_found = True
-                        yield uid, attachment
-                if self.fetch_one and attachments_found:
-                    return
+        for uid, mail in self.get_emails(imap, matched_uids):
+            for attachment in iter_attachments(mail, filename_match):
+                attachments_found = True
+                yield uid, attachment
+            if self.fetch_one and attachments_found:
+                return
         if not attachments_found:
             raise EmailDownloaderError("0 attachments were found matching the criteria.")
 
+    def get_emails(self, imap, uids):
+        """Yield tuples of (uid, email.message.EmailMessage) for the uids, in the order that the uids are given.
+
+        The full emails are fetched one at a time, so that only one raw email (which may carry large attachments) is
+        held in memory at once. BODY.PEEK[] is used so that the emails aren't marked as seen.
+
+        Positional Arguments:
+        1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
+        2. uids (iterable): the uids to fetch
+
+        """
+        parse_email = self._parse_email
+        for uid in uids:
+            for _, raw_mail in self.fetch(imap, [uid], "(BODY.PEEK[])"):
+                yield uid, parse_email(raw_mail)
+
+    def get_search_criteria(self):
+        """Return the list of IMAP SEARCH criteria used to narrow down the uids on the server.
+
+        RFC 3501 defines the SUBJECT and FROM criteria as case-insensitive substring matches, but some servers (e.g.
+        Gmail and Exchange) match whole words or word prefixes instead. Only the whole words that the subject and
+        sender patterns must begin with are searched for, which avoids excluding matching emails in either case, but
+        servers that tokenise punctuation unusually could still miss some. The patterns are still applied to the
+        fetched headers afterwards. Non-ASCII prefixes are left out as they would
+        require a CHARSET argument, which not all servers support.
+
+        """
+        criteria = []
+        if self.match_date_received:
+            criteria += ["ON", (self.load_date + datetime.timedelta(days=1)).strftime("%d-%b-%Y")]
+        elif self.search_window:
+            criteria += ["SINCE", (self.load_date - datetime.timedelta(days=self.search_window)).strftime("%d-%b-%Y")]
+        for key, pattern in (("SUBJECT", self.email_subject), ("FROM", self.email_sender)):
+            prefix = self._literal_prefix(pattern)
+            if prefix and all(ord(character) < 128 for character in prefix):
+                criteria += [key, self._quote(prefix)]
+        return criteria or ["ALL"]
+
+    def match_uids(self, imap, uids):
+        """Yield the uids of the emails whose subject and sender match the given patterns, in the order given.
+
+        Only the Subject and From headers are fetched here, so the bodies (and attachments) of emails that don't match
+        are never downloaded. The headers are fetched lazily, batch by batch, so if fetch_one is True the batches are
+        kept small (20 uids) as iteration will most likely stop at the first match.
+
+        Positional Arguments:
+        1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
+        2. uids (iterable): the uids to filter
+
+        """
+        parse_headers = email.parser.BytesHeaderParser().parsebytes
+        subject_match = self._subject_ok
+        sender_match = self._sender_ok
+        batch_size = min(_FETCH_ONE_BATCH_SIZE, self.fetch_batch_size) if self.fetch_one else self.fetch_batch_size
+        for uid_batch in self._iter_batches(uids, batch_size):
+            raw_headers = dict(self.fetch(imap, uid_batch, "(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)])"))
+            for uid in uid_batch:
+                headers = parse_headers(raw_headers[uid])
+                if subject_match(headers["Subject"]) and sender_match(headers["From"]):
+                    yield uid
+
     def run(self):
         """Run the end to end download and upload process."""
         self.logger.info("EXECUTION STARTED")
         self.logger.info("Connecting to, and authenticating with, the IMAP server over SSL...")
-        with imaplib.IMAP4_SSL(self.imap_ssl_host) as imap:
+        with _DeflateIMAP4_SSL(self.imap_ssl_host) as imap:
             imap.login(self.username, self.password)
+            if imap.compress():
+                self.logger.info("Compressing the connection to the IMAP server...")
+            # selected once, read-write only if matched emails are to be archived. Emails are only fetched with
+            # BODY.PEEK so they aren't marked as seen
+            self.raise_if_not_ok(*imap.select(readonly=self.archive_folder is None))
             self.logger.info("Getting attachments that match the provided criteria...")
             attachments = self.get_attachments(imap)
-            uids_to_move = set()
-            self.logger.info("Recording all email unique IDs that need to be archived...")
             self.logger.info("Uploading attachments...")
-            for uid, attachment in attachments:
-                self.upload(attachment)
-                uids_to_move.add(uid)
+            # resolved once here as the upload threads only need to append the filename
+            self._blob_prefix = self.acquire_program.get_blob_name("{ExecutionDataSetName}_{ExecutionLoadDate}_")
+            # the uploads are only network I/O so can overlap, but imap is not thread safe so stays on this thread
+            # the number of uploads in flight is capped, so that attachments aren't fetched faster than they're
+            # uploaded and held in memory all at once
+            uploads = {}
+            pending = set()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=_UPLOAD_WORKERS) as executor:
+                for uid, attachment in attachments:
+                    if len(pending) >= _MAX_PENDING_UPLOADS:
+                        pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)[1]
+                    upload = executor.submit(self.upload, attachment)
+                    uploads[upload] = uid
+                    pending.add(upload)
+            self.logger.info("Recording all email unique IDs that need to be archived...")
+            uids_to_move = []
+            failed_uids = set()
+            for upload, uid in uploads.items():  # all done by now, and in the order the attachments were found
+                error = upload.exception()
+                if error is None:
+                    uids_to_move.append(uid)
+                else:
+                    failed_uids.add(uid)
+                    self.logger.error("Failed to upload an attachment from email %s", uid.decode(), exc_info=error)
+            # an email with several matching attachments appears once per attachment
+            uids_to_move = [uid for uid in dict.fromkeys(uids_to_move) if uid not in failed_uids]
             self.logger.info("Archiving matched emails...")
-            if self.archive_folder is not None:
+            if self.archive_folder is not None and uids_to_move:
                 self.archive_uids(imap, uids_to_move)
+            if failed_uids:
+                raise EmailDownloaderError("Attachments from %d email(s) failed to upload." % len(failed_uids))
         self.logger.info("EXECUTION FINISHED")
 
-    def sort_uids(self, imap, uids):
-        """Sort the uids by most recent and return as a sorted dict mapping uids to email.message.EmailMessage objects.
-
-        Positional Arguments:
-        1. imap (imaplib.IMAP4_SSL): the logged in imap object to use to interact with the email server
-        2. uids (iterable): the uids to sort
-
-        """
-        unsorted_emails = {}
-        for uid in uids:
-            raw_mail = imap.uid("fetch", uid, "(RFC822)")[1][0][1]
-            mail = email.message_from_bytes(raw_mail, _class=email.message.EmailMessage)
-            unsorted_emails[uid] = mail
-        return collections.OrderedDict(sorted(unsorted_emails.items(), key=self._item_to_datetime, reverse=True))
-
     def upload(self, attachment):
         """Upload the attachment's byte payload to Titan's blob storage.
 
+        The blob name prefix is resolved by run() before any uploads start, so an EmailDownloaderError is raised if
+        this is called outside of run().
+
         Positional Arguments:
         1. attachment (email.message.EmailMessage): the attachment whose byte payload should be uploaded
 
         """
-        blob_name = self.acquire_program.get_blob_name("{ExecutionDataSetName}_{ExecutionLoadDate}_{file_name}",
-                                                       file_name=attachment["Content-Description"])
-        self.acquire_program.create_blob_from_bytes(attachment.get_payload(decode=True), blob_name=blob_name)
+        if self._blob_prefix is None:
+            raise EmailDownloaderError("The blob name prefix has not been resolved; attachments are uploaded by run().")
+        blob_name = self._blob_prefix + attachment["Content-Description"]
+        if attachment.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+            payload = io.BytesIO()
+            for chunk in self._iter_decoded_payload(attachment):
+                payload.write(chunk)
+            payload = payload.getvalue()  # doesn't copy the buffer as nothing else references it
+        else:
+            payload = attachment.get_payload(decode=True)
+        self.acquire_program.create_blob_from_bytes(payload, blob_name=blob_name)
 
 
 @click.command()
@@ -208,10 +645,10 @@ class TitanFlowManager(object):
 @click.option("-u", "--username", required=True, help="The username to connect to the IMAP server with. Typically, "
               "this is the full email address.")
 @click.option("-p", "--password", required=True, help="The password to connect to the IMAP server with.")
-@click.option("-f", "--fetch-one", type=bool, required=True, help="Whether to return after uploading one email with "
-              "attachments that match the criteria or all emails.")
-@click.option("-m", "--match-date-received", type=bool, default=False, help="If True, the search will be restricted to "
-              "emails that were received the day after the --load-date value. Defaults to False.")
+@click.option("-f", "--fetch-one", is_flag=True, default=False, help="If set, return after uploading one email with "
+              "attachments that match the criteria, otherwise upload all matching emails.")
+@click.option("-m", "--match-date-received", is_flag=True, default=False, help="If set, the search will be restricted "
+              "to emails that were received the day after the --load-date value.")
 @click.option("-e", "--email-subject", default=".*", help="The regular expression pattern to use to match email "
               "subjects. Defaults to r\".*\"")
 @click.option("-s", "--email-sender", default=".*", help="The regular expression pattern to use to match email "
@@ -223,11 +660,18 @@ class TitanFlowManager(object):
 @click.option("-a", "--archive-folder", help="If provided, all 'matched' emails will be moved to this folder. If the "
               "archive folder is a sub folder, use parent/child syntax. Note that the existence of this folder is "
               "checked immediately to avoid a situation where attachments are succesfully downloaded & uploaded but "
-              "the emails unmoved. Defaults to None.")
+              "the emails unmoved. The name must not contain the wildcards % or *. Defaults to None.")
+@click.option("-b", "--fetch-batch-size", type=click.IntRange(min=1), default=100, help="The maximum number of "
+              "emails whose headers are requested from the IMAP server in a single FETCH command (full emails are "
+              "always fetched one at a time). Lower this if the server rejects requests for being too large. Defaults "
+              "to 100.")
+@click.option("-w", "--search-window", type=click.IntRange(min=0), default=30, help="Unless --match-date-received "
+              "is set, the search will be restricted to emails that were received at most this number of days before "
+              "the --load-date value. If 0, all emails are searched. Defaults to 30.")
 @click.option("-l", "--load-date", type=_DateType(), help="If provided, must be in the format of YYYY-MM-DD. Defaults "
               "to yesterday.")
 def main(imap_ssl_host, username, password, fetch_one, match_date_received, email_subject, email_sender,
-         filename_pattern, archive_folder, load_date):
+         filename_pattern, archive_folder, fetch_batch_size, search_window, load_date):
     """Download attachments from an email account that match given criteria and upload directly to Titan's blob storage.
 
     Look for emails containing attachments that match the provided pattern and download either the most recent one
@@ -237,10 +681,11 @@ def main(imap_ssl_host, username, password, fetch_one, match_date_received, emai
     """
     if load_date is None:
         load_date = (datetime.datetime.now() - datetime.timedelta(days=1)).date()
-    yyyy, mm, dd = str(load_date).split("-")
-    filename_pattern = filename_pattern.replace("YYYY", yyyy).replace("MM", mm).replace("DD", dd)
+    date_parts = {"YYYY": "%04d" % load_date.year, "MM": "%02d" % load_date.month, "DD": "%02d" % load_date.day}
+    filename_pattern = re.sub("YYYY|MM|DD", lambda match: date_parts[match.group()], filename_pattern)
     flow_manager = TitanFlowManager(imap_ssl_host, username, password, fetch_one, match_date_received, email_subject,
-                                    email_sender, filename_pattern, archive_folder, load_date)
+                                    email_sender, filename_pattern, archive_folder, load_date, fetch_batch_size,
+                                    search_window)
     try:
         flow_manager.run()
     except Exception as error: